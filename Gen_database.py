@@ -1,4 +1,11 @@
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import warnings
 import streamlit as st
 from io import BytesIO
@@ -17,37 +24,105 @@ def merge_excel_to_parquet_bytes(uploaded_file) -> tuple[bytes, dict]:
     อ่าน Excel ทุกชีท -> ทำความสะอาด -> concat -> export parquet เป็น bytes
     คืนค่า: (parquet_bytes, stats_dict)
     """
-    # อ่านทุกชีทเป็น dict {sheet_name: df}
-    all_sheets = pd.read_excel(uploaded_file, sheet_name=None, dtype=str)
+    # materialize bytes ครั้งเดียวเป็น zero-copy memoryview แล้วอ่านผ่าน BufferReader
+    # (ไม่ต้อง read()/seek() ผ่าน wrapper ของ UploadedFile ซ้ำๆ ระหว่าง parse หลายชีท)
+    buf = pa.py_buffer(uploaded_file.getbuffer())
 
-    all_data_frames = []
+    # อ่านทุกชีทเป็น dict {sheet_name: df}
+    # ใช้ engine="calamine" (Rust-based) อ่านเร็วกว่า openpyxl หลายเท่าบนไฟล์ใหญ่
+    # ไม่บังคับ dtype=str — เก็บ type จริงให้ parquet ใช้ dictionary/RLE encoding ได้เต็มที่
+    all_sheets = pd.read_excel(pa.BufferReader(buf), sheet_name=None, engine="calamine")
+
+    def _clean_sheet(item):
+        sheet_name, df = item
+        try:
+            tbl = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowTypeError, pa.ArrowInvalid):
+            # คอลัมน์ type ผสม (เช่น ตัวเลขที่มี text หลุดมา cell เดียว) ทำให้ Arrow
+            # แปลงไม่ได้ — cast คอลัมน์ object เป็น string (NaN ยังเป็น null อยู่) แล้วลองใหม่
+            df = df.copy()
+            for c in df.columns[df.dtypes == object]:
+                df[c] = df[c].astype("string")
+            tbl = pa.Table.from_pandas(df, preserve_index=False)
+
+        # 1) ลบคอลัมน์ Unnamed (ตัดที่ระดับชื่อคอลัมน์ ไม่ต้องสแกน/copy ข้อมูล)
+        keep_cols = [n for n in tbl.column_names if not n.startswith("Unnamed")]
+        tbl = tbl.select(keep_cols)
+
+        # 2) ลบแถวว่างทั้งหมด (Arrow null kernel ทำงานแบบ vectorized ทั้งคอลัมน์)
+        if tbl.num_columns > 0 and tbl.num_rows > 0:
+            all_null = functools.reduce(pc.and_, [pc.is_null(tbl[c]) for c in tbl.column_names])
+            tbl = tbl.filter(pc.invert(all_null))
+
+        return sheet_name, tbl
+
+    # ทำความสะอาดแต่ละชีทขนานกันได้ (Arrow kernel ปล่อย GIL ระหว่างทำงาน)
+    with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as pool:
+        cleaned = list(pool.map(_clean_sheet, all_sheets.items()))
+
+    tables = []
     per_sheet_rows = {}
+    for sheet_name, tbl in cleaned:
+        per_sheet_rows[sheet_name] = tbl.num_rows
+        if tbl.num_rows > 0:
+            tables.append(tbl)
 
-    for sheet_name, df in all_sheets.items():
-        # 1) ลบคอลัมน์ Unnamed (รองรับชื่อคอลัมน์เป็นตัวเลข)
-        df = df.loc[:, ~df.columns.astype(str).str.contains(r"^Unnamed")].copy()
-
-        # 2) ลบแถวว่างทั้งหมด
-        df = df.dropna(how="all")
-
-        per_sheet_rows[sheet_name] = len(df)
-
-        if len(df) > 0:
-            all_data_frames.append(df)
-
-    if not all_data_frames:
+    if not tables:
         raise ValueError("ไม่พบข้อมูลหลังทำความสะอาด (ทุกชีทว่างหรือถูกลบหมด)")
 
-    merged_df = pd.concat(all_data_frames, ignore_index=True)
+    # concat ครั้งเดียวแบบ zero-copy (ต่อ chunk ของ Arrow buffer ไม่ copy ข้อมูลซ้ำทุกชีท)
+    # "permissive" ยอม promote type ข้ามชีทให้ (เช่น int64 + double → double)
+    # ซึ่งเกิดทุกครั้งที่ชีทหนึ่งมี cell ว่างในคอลัมน์ตัวเลข
+    try:
+        merged = pa.concat_tables(tables, promote_options="permissive")
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        # คอลัมน์ที่ permissive ก็เทียบไม่ได้ (string ชีทหนึ่ง ตัวเลขอีกชีท) —
+        # cast เฉพาะคอลัมน์ที่ type ชนกันเป็น string แล้ว concat ใหม่
+        types_by_name = {}
+        for t in tables:
+            for field in t.schema:
+                types_by_name.setdefault(field.name, set()).add(field.type)
+
+        def _irreconcilable(name, types):
+            if len(types) < 2:
+                return False
+            try:
+                pa.unify_schemas(
+                    [pa.schema([pa.field(name, tp)]) for tp in types],
+                    promote_options="permissive",
+                )
+                return False
+            except (pa.ArrowTypeError, pa.ArrowInvalid):
+                return True
+
+        mixed = {n for n, ts in types_by_name.items() if _irreconcilable(n, ts)}
+        unified = [
+            pa.table(
+                [pc.cast(t[n], pa.string()) if n in mixed else t[n] for n in t.column_names],
+                names=t.column_names,
+            )
+            for t in tables
+        ]
+        merged = pa.concat_tables(unified, promote_options="permissive")
 
     # export parquet เป็น bytes
+    # dictionary + ZSTD บีบคอลัมน์ string ซ้ำๆ ได้ดีกว่า snappy default มาก
+    # row group เล็กลงช่วยให้ DuckDB ทำ predicate pushdown ตอน query ได้ดีขึ้น
     buffer = BytesIO()
-    merged_df.to_parquet(buffer, index=False, engine="pyarrow")
+    pq.write_table(
+        merged,
+        buffer,
+        compression="zstd",
+        compression_level=3,
+        use_dictionary=True,
+        row_group_size=256_000,
+        data_page_version="2.0",
+    )
     parquet_bytes = buffer.getvalue()
 
     stats = {
         "sheet_count": len(all_sheets),
-        "merged_rows": len(merged_df),
+        "merged_rows": merged.num_rows,
         "per_sheet_rows": per_sheet_rows,
         "parquet_size_mb": len(parquet_bytes) / (1024 * 1024),
     }
@@ -92,8 +167,10 @@ if uploaded:
                 )
 
                 if preview:
-                    # อ่าน parquet bytes กลับมาเพื่อ preview (กันพลาดกรณีข้อมูลใหญ่)
-                    df_preview = pd.read_parquet(BytesIO(parquet_bytes), engine="pyarrow")
+                    # preview แค่ batch แรก 200 แถว — ไม่ต้อง decode row group ที่เหลือทั้งไฟล์
+                    pf = pq.ParquetFile(pa.BufferReader(pa.py_buffer(parquet_bytes)))
+                    first_batch = next(pf.iter_batches(batch_size=200))
+                    df_preview = pa.Table.from_batches([first_batch]).to_pandas()
                     st.subheader("Preview (หัวตาราง 200 แถวแรก)")
                     st.dataframe(df_preview.head(200), use_container_width=True)
 
@@ -1,8 +1,12 @@
 import streamlit as st
 import pandas as pd
 import duckdb
+import functools
+import hashlib
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import uuid
-import time
 
 st.set_page_config(page_title="SQL Query", layout="wide")
 
@@ -12,12 +16,25 @@ try:
 except Exception:
     ACE_AVAILABLE = False
 
+try:
+    import sqlglot
+    SQLGLOT_AVAILABLE = True
+except Exception:
+    SQLGLOT_AVAILABLE = False
+
+try:
+    import xxhash
+    XXHASH_AVAILABLE = True
+except Exception:
+    XXHASH_AVAILABLE = False
+
 
 # =====================
 # SESSION STATE
 # =====================
-if "data_frame" not in st.session_state:
-    st.session_state.data_frame = None
+# ข้อมูลที่อัปโหลดเก็บเป็น pyarrow Table ก้อนเดียว ใช้ร่วมกับ DuckDB แบบ zero-copy
+if "arrow_table" not in st.session_state:
+    st.session_state.arrow_table = None
 
 if "query_pages" not in st.session_state:
     first_id = str(uuid.uuid4())
@@ -41,21 +58,82 @@ if "is_switching_page" not in st.session_state:
 if "run_id" not in st.session_state:
     st.session_state.run_id = 0
 
+# เพดานจำนวนแถวที่ดึงมาเก็บ/แสดงผลต่อหนึ่ง query (กัน memory บวมถ้า user ใส่ LIMIT ใหญ่เอง)
+MAX_RESULT_ROWS = 100_000
+
 
 # =====================
 # DATA LOADER
 # =====================
-@st.cache_data(show_spinner="Loading & Cleaning data...")
-def load_uploaded_file(uploaded_file):
-    if uploaded_file.name.endswith(".parquet"):
-        df = pd.read_parquet(uploaded_file).astype(str)
+# memoize ตาม SQL เดิม — กด Run ซ้ำด้วย query เดิมไม่ต้อง parse/render ใหม่
+@functools.lru_cache(maxsize=64)
+def ensure_limit(q: str, n: int = 300) -> str:
+    """เติม LIMIT ที่ระดับ AST — ไม่ false-match คอลัมน์ชื่อ limit_xxx หรือคำว่า LIMIT ใน string
+    และต่อท้าย query ที่มี comment/UNION ได้ถูกต้อง"""
+    if SQLGLOT_AVAILABLE:
+        try:
+            tree = sqlglot.parse_one(q, dialect="duckdb")
+            if not tree.args.get("limit"):
+                tree = tree.limit(n)
+            return tree.sql(dialect="duckdb")
+        except Exception:
+            pass
+    # fallback แบบ substring เดิม ถ้า parse ไม่ได้
+    if "limit" not in q.lower():
+        q += f" LIMIT {n}"
+    return q
+
+
+def get_con():
+    # connection เดียวต่อ session เก็บใน session_state (ไม่ต้องเปิด/ผูกตารางใหม่
+    # ทุกครั้งที่กด Run) — ห้ามใช้ cache_resource เพราะ process-global จะทำให้
+    # ตาราง "database" ที่ register ไว้ถูกผู้ใช้คนอื่นทับ
+    if "duckdb_con" not in st.session_state:
+        st.session_state.duckdb_con = duckdb.connect()
+    return st.session_state.duckdb_con
+
+
+def _hash_bytes(data: bytes):
+    # xxh3 hash ได้ระดับ 10+ GB/s — แทน hasher default ของ Streamlit สำหรับไฟล์ใหญ่
+    if XXHASH_AVAILABLE:
+        return xxhash.xxh3_64_intdigest(data)
+    return hashlib.sha1(data).hexdigest()
+
+
+# รับ (ชื่อ, bytes) ตรงๆ แทน UploadedFile — cache key เป็น hash ของ bytes ล้วนๆ
+# cache_resource เก็บผลลัพธ์แบบ reference — cache hit ไม่ต้อง pickle/unpickle ตารางใหญ่
+@st.cache_resource(
+    show_spinner="Loading & Cleaning data...",
+    hash_funcs={bytes: _hash_bytes},
+)
+def load_uploaded_file(name: str, data: bytes) -> pa.Table:
+    # เก็บ dtype จริงไว้ (ไม่บังคับเป็น string ทั้งตาราง) — ตัวเลขกินเมมน้อยกว่ามาก
+    # และ DuckDB ใช้ SIMD filter/group บนคอลัมน์ typed ได้เต็มที่
+    if name.endswith(".parquet"):
+        tbl = pq.read_table(pa.BufferReader(data))
     else:
-        df = pd.read_excel(uploaded_file, dtype=str)
-
-    df = df.fillna("").replace("nan", "")
-    df = df.apply(lambda x: x.str.strip() if x.dtype == "object" else x)
-    df.columns = df.columns.str.strip().str.replace(" ", "_")
-    return df
+        df = pd.read_excel(pa.BufferReader(data))
+        try:
+            tbl = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowTypeError, pa.ArrowInvalid):
+            # คอลัมน์ type ผสม (ตัวเลขที่มี text หลุดมา cell เดียว) ทำให้ Arrow แปลงไม่ได้
+            # — cast คอลัมน์ object เป็น string (NaN ยังเป็น null อยู่) แล้วลองใหม่
+            df = df.copy()
+            for c in df.columns[df.dtypes == object]:
+                df[c] = df[c].astype("string")
+            tbl = pa.Table.from_pandas(df, preserve_index=False)
+
+    # รวม fillna / ลบ "nan" / strip / เปลี่ยนชื่อคอลัมน์ เป็น pipeline เดียวบน Arrow
+    # (สแกน string รอบเดียว แทนการไล่ทั้ง frame สี่รอบ)
+    cleaned = []
+    for col in tbl.columns:
+        if pa.types.is_string(col.type) or pa.types.is_large_string(col.type):
+            col = pc.replace_substring_regex(
+                pc.utf8_trim_whitespace(pc.fill_null(col, "")), r"^nan$", ""
+            )
+        cleaned.append(col)
+    names = [str(n).strip().replace(" ", "_") for n in tbl.column_names]
+    return pa.table(cleaned, names=names)
 
 
 # =====================
@@ -109,14 +187,16 @@ def main():
     st.title("SQL Query")
 
     # ---------- Upload ----------
-    if st.session_state.data_frame is None:
+    if st.session_state.arrow_table is None:
         uploaded = st.file_uploader("📂 Upload File (.xlsx / .parquet)", type=["xlsx", "parquet"])
         if uploaded:
-            st.session_state.data_frame = load_uploaded_file(uploaded)
+            tbl = load_uploaded_file(uploaded.name, uploaded.getvalue())
+            st.session_state.arrow_table = tbl
+            get_con().register("database", tbl)
             st.rerun()
         return
 
-    df = st.session_state.data_frame
+    tbl = st.session_state.arrow_table
 
     # ---------- Sidebar ----------
     with st.sidebar:
@@ -124,7 +204,7 @@ def main():
             st.session_state.clear()
             st.rerun()
 
-        st.metric("📦 Total Rows", f"{len(df):,}")
+        st.metric("📦 Total Rows", f"{tbl.num_rows:,}")
         st.divider()
 
     # ---------- Page selector ----------
@@ -204,17 +284,28 @@ def main():
     # ---------- Run ----------
     if submitted:
         with st.spinner("⏳ Running SQL..."):
-            time.sleep(0.25)  # just a tiny spin so user sees feedback
             try:
                 q = (page["query"] or "").strip().rstrip(";")
                 if not q:
                     raise ValueError("SQL ว่างอยู่ครับ")
 
-                if "limit" not in q.lower():
-                    q += " LIMIT 300"
-
-                result = duckdb.query(q.replace("database", "df")).to_df()
-                page["last_result"] = result
+                q = ensure_limit(q)
+
+                # ตาราง Arrow ถูก register ไว้กับ connection กลางตั้งแต่ตอนอัปโหลด
+                # (zero-copy scan, ไม่มีการแทนที่คำว่า "database" ใน SQL อีกแล้ว)
+                # ดึงผลแบบ streaming ทีละ batch แล้วหยุดเมื่อถึงเพดาน
+                # แทนการ materialize ทั้ง result ก่อนค่อยตัด
+                reader = get_con().execute(q).to_arrow_reader(batch_size=10_000)
+                batches, fetched_rows = [], 0
+                for batch in reader:
+                    batches.append(batch)
+                    fetched_rows += batch.num_rows
+                    if fetched_rows >= MAX_RESULT_ROWS:
+                        reader.close()
+                        break
+                # เก็บผลเป็น pa.Table ตรงๆ — ไม่ต้อง round-trip Arrow→pandas→Arrow
+                # (st.dataframe แปลงเป็น Arrow IPC ส่งให้ browser อยู่แล้ว)
+                page["last_result"] = pa.Table.from_batches(batches, schema=reader.schema)
 
                 # ✅ bump run_id so result table refreshes even if same shape
                 st.session_state.run_id += 1
@@ -227,17 +318,22 @@ def main():
     # ---------- Result ----------
     if page["last_result"] is not None:
         res = page["last_result"]
-        st.success(f"Query Success: {len(res):,} rows")
+        st.success(f"Query Success: {res.num_rows:,} rows")
 
         with st.expander("📋 Copy Data for Excel (All rows in result)"):
-            st.code(res.to_csv(index=False, sep="\t"), language="text")
+            # ใช้ to_csv เพราะ quote เฉพาะที่จำเป็น — CSV writer ของ Arrow ครอบ
+            # double quote ทุกค่า string ซึ่งโชว์ในกล่อง copy ตรงๆ
+            # (ผลลัพธ์ถูก cap ที่ MAX_RESULT_ROWS แล้ว ไม่ใช่คอขวด)
+            tsv_text = res.to_pandas().to_csv(index=False, sep="\t")
+            st.code(tsv_text, language="text")
 
         st.divider()
         st.subheader("Result Table")
 
         # ✅ key includes run_id to force refresh after each Run
+        # ส่งให้ browser แค่ 1,000 แถวแรกพอ (zero-copy slice บน Arrow table)
         st.dataframe(
-            res,
+            res.slice(0, 1000),
             use_container_width=True,
             key=f"result_{page_id}_{st.session_state.run_id}",
         )
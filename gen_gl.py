@@ -1,13 +1,25 @@
 import streamlit as st
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import os
 import re
 import zipfile
 import tempfile
 import io
-from openpyxl.styles import Border, Side, Alignment, Font, PatternFill
+import openpyxl
+from openpyxl.styles import Border, Side, Alignment, Font, PatternFill, NamedStyle
 from openpyxl.utils import get_column_letter
 
+# --- Pre-compiled Patterns ---
+# compile ครั้งเดียวตอน import แทนการวิ่งผ่าน re cache ทุกครั้ง
+# (extract_seq_num ถูก apply ทุกแถวของ GL)
+_SEQ_RE = re.compile(r'seq_num:(\d+)')
+_D_RE = re.compile(r'[-_]?D(?P<d>\d{6})', re.IGNORECASE)
+_JV_RE = re.compile(r'JV(?P<jv>\d{8})', re.IGNORECASE)
+_STRIP_D_RE = re.compile(r'[-_]?D\d{6}.*$', re.IGNORECASE)
+
 # --- Helper Functions ---
 def excel_col_to_index(col_str):
     num = 0
@@ -17,30 +29,29 @@ def excel_col_to_index(col_str):
         num = num * 26 + (ord(c.upper()) - ord('A')) + 1
     return num - 1
 
-def convert_implied_decimal(val):
-    try:
-        val_str = str(val).strip()
-        return float(val_str) / 100.0
-    except:
-        return val
+def convert_implied_decimal(series):
+    # หาร 100 ทั้งคอลัมน์แบบ vectorized; ค่าที่แปลงเป็นตัวเลขไม่ได้คงค่าเดิมไว้
+    # (แทน try/except ทีละ cell ซึ่งแพงมากตอนเจอแถวที่ไม่ใช่ตัวเลข)
+    num = pd.to_numeric(series.astype(str).str.strip(), errors='coerce') / 100.0
+    return num.where(num.notna(), series)
 
 def extract_seq_num(val):
     text = str(val)
-    match = re.search(r'seq_num:(\d+)', text)
+    match = _SEQ_RE.search(text)
     if match:
         return match.group(1)
-    return str(val).strip()
+    return text.strip()
 
 def parse_dates_from_filename(filename: str):
     base = os.path.basename(filename)
-    d_match = re.search(r'[-_]?D(?P<d>\d{6})', base, flags=re.IGNORECASE)
+    d_match = _D_RE.search(base)
     d_date = d_match.group('d') if d_match else None
 
-    jv_match = re.search(r'JV(?P<jv>\d{8})', base, flags=re.IGNORECASE)
+    jv_match = _JV_RE.search(base)
     jv_date = None
     if jv_match:
         jv_full = jv_match.group('jv')
-        jv_date = jv_full[2:4] + jv_full[4:6] + jv_full[6:8] 
+        jv_date = jv_full[2:4] + jv_full[4:6] + jv_full[6:8]
     return d_date, jv_date
 
 def pick_latest_files_by_duplicate_d_date(folder_path: str, files_list: list):
@@ -79,14 +90,45 @@ def pick_latest_files_by_duplicate_d_date(folder_path: str, files_list: list):
     results.sort(key=lambda x: os.path.basename(x["file"]).lower())
     return results
 
-def strip_d_suffix_for_tlf_sheet(name_no_ext: str):
-    return re.sub(r'[-_]?D\d{6}.*$', '', name_no_ext, flags=re.IGNORECASE).strip()
+def _cell_to_str(val):
+    # แปลงเป็น string + strip ตั้งแต่ตอน parse (ผ่าน converters) แทนการอ่าน dtype=str
+    # แล้วไล่ astype(str).str.strip() ซ้ำอีกรอบทั้ง frame
+    if val is None or (isinstance(val, float) and val != val):
+        return 'nan'  # ให้ผลเหมือน astype(str) ของค่า NaN แบบเดิม
+    return str(val).strip()
 
-def make_unique_sheet_name(book, desired_name: str):
+def strip_d_suffix_for_tlf_sheet(name_no_ext: str):
+    return _STRIP_D_RE.sub('', name_no_ext).strip()
+
+def build_search_key(keys: pd.Series) -> pd.Series:
+    # key = "<ค่า>|<ลำดับครั้งที่เจอค่านั้น>" สำหรับสูตร MATCH ใน Search UI
+    # cumcount ด้วย numpy ล้วน: factorize เป็น integer codes แล้วใช้ stable argsort
+    # จัดกลุ่ม code เดียวกันติดกัน — ตำแหน่งใน run คือลำดับครั้งที่เจอ
+    # ไม่ต้องผ่าน groupby machinery ของ pandas เลย
+    codes, _ = pd.factorize(keys.to_numpy(), use_na_sentinel=False)
+    order = np.argsort(codes, kind='stable')
+    grouped = codes[order]
+    run_starts = np.flatnonzero(np.r_[True, grouped[1:] != grouped[:-1]])
+    run_lengths = np.diff(np.r_[run_starts, len(codes)])
+    within_run = np.arange(len(codes)) - np.repeat(run_starts, run_lengths)
+    occurrence = np.empty(len(codes), dtype=np.int64)
+    occurrence[order] = within_run + 1
+    # ต่อ string ใน Arrow (buffer เดียวต่อคอลัมน์) แทน object-dtype `+` ของ pandas
+    # ที่สร้าง PyObject string ใหม่ทีละแถวสองรอบ
+    joined = pc.binary_join_element_wise(
+        pa.array(keys, type=pa.string()),
+        pa.array(occurrence.astype(str)),
+        '|',
+    )
+    return pd.Series(joined.to_numpy(zero_copy_only=False), index=keys.index)
+
+def make_unique_sheet_name(used_names: set, desired_name: str):
+    # used_names เป็น set ที่ caller ดูแลเอง — เช็คซ้ำแบบ O(1)
+    # ไม่ต้องไล่สแกน book.sheetnames (list) ใหม่ทุกไฟล์
     base = (desired_name or "Sheet")[:31]
     name = base
     i = 2
-    while name in book.sheetnames:
+    while name in used_names:
         suffix = f"_{i}"
         name = (base[:31 - len(suffix)] + suffix)[:31]
         i += 1
@@ -109,12 +151,18 @@ tlf_columns_letters = [
 gl_indices = [excel_col_to_index(c) for c in gl_columns_letters]
 tlf_indices = [excel_col_to_index(c) for c in tlf_columns_letters]
 
+# ตาราง column letter คำนวณล่วงหน้า — loop สร้างสูตร/auto width เรียกใช้ถี่มาก
+# index ด้วย _COL_LETTERS[i - 1] แทนการประกอบ string ใหม่ทุกครั้ง
+_COL_LETTERS = [get_column_letter(i) for i in range(1, 201)]
+
+# ตำแหน่งของแต่ละ letter ใน TLF ที่เลือกไว้ (เรียงตาม index) คำนวณครั้งเดียวตอน import
+_TLF_LETTER_POS = {
+    letter: i
+    for i, letter in enumerate(sorted(tlf_columns_letters, key=excel_col_to_index))
+}
+
 def get_col_pos_in_tlf(target_letter):
-    sorted_letters = sorted(tlf_columns_letters, key=lambda x: excel_col_to_index(x))
-    try:
-        return sorted_letters.index(target_letter)
-    except:
-        return -1
+    return _TLF_LETTER_POS.get(target_letter, -1)
 
 pos_AZ = get_col_pos_in_tlf('AZ')
 pos_CU = get_col_pos_in_tlf('CU')
@@ -123,10 +171,28 @@ pos_CU = get_col_pos_in_tlf('CU')
 thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
 align_center = Alignment(horizontal='center', vertical='center')
 align_right = Alignment(horizontal='right', vertical='center')
-header_font = Font(bold=True)
 title_font = Font(bold=True, size=14, color="000000")
+raw_label_font = Font(bold=True, italic=True)
+search_title_font = Font(bold=True, size=12)
 search_fill = PatternFill(start_color="FFFF00", end_color="FFFF00", fill_type="solid")
 
+def register_data_styles(book):
+    """ลงทะเบียน NamedStyle ครั้งเดียวต่อ workbook — loop ข้อมูลดิบใส่สไตล์ด้วย
+    string reference (cell.style = 'ชื่อ') แทนการ set border/alignment/number_format
+    ทีละ attribute ทุก cell ซึ่งสร้าง StyleArray ใหม่สามรอบต่อ cell"""
+    book.add_named_style(NamedStyle(name='raw_header', font=Font(bold=True),
+                                    border=thin_border, alignment=align_center))
+    book.add_named_style(NamedStyle(name='data_center', border=thin_border, alignment=align_center))
+    book.add_named_style(NamedStyle(name='data_right', border=thin_border, alignment=align_right))
+    book.add_named_style(NamedStyle(name='data_money', border=thin_border, alignment=align_right,
+                                    number_format='#,##0.00'))
+    book.add_named_style(NamedStyle(name='data_text', border=thin_border, alignment=align_center,
+                                    number_format='@'))
+    book.add_named_style(NamedStyle(name='report_header', font=Font(bold=True), border=thin_border,
+                                    alignment=align_center,
+                                    fill=PatternFill(start_color="D9D9D9", end_color="D9D9D9",
+                                                     fill_type="solid")))
+
 
 # --- Main Logic Function ---
 def process_data_in_memory(tlf_path, source_files_list, temp_folder):
@@ -134,271 +200,309 @@ def process_data_in_memory(tlf_path, source_files_list, temp_folder):
     
     # [FIX] ใช้ with block เพื่อเปิดและปิดไฟล์ TLF อัตโนมัติ ป้องกัน WinError 32
     try:
-        with pd.ExcelFile(tlf_path) as tlf_book:
+        with pd.ExcelFile(tlf_path, engine='openpyxl') as tlf_book:
             
             # 2. Filter Source Files
             files_to_process = pick_latest_files_by_duplicate_d_date(temp_folder, source_files_list)
             if not files_to_process:
                 return None, "ไม่พบไฟล์ข้อมูล (GL/TRF) ที่ถูกต้องใน ZIP"
 
-            # 3. Create Excel Writer
-            with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                for item in files_to_process:
-                    file_path = item["file"]
-                    filename = os.path.basename(file_path)
-                    chosen_d_date = item["d_date"]
+            # อ่านชีท TLF แต่ละชีทจาก XML แค่ครั้งเดียว — หลายไฟล์ GL มักชี้มาชีทเดียวกัน
+            tlf_sheet_cache = {}
+            # set ของชื่อชีทสร้างครั้งเดียว — เช็ค candidate ต่อไฟล์เป็น O(1)
+            tlf_sheet_names_set = set(tlf_book.sheet_names)
+
+            # 3. Create Workbook
+            # สร้าง workbook ตรงๆ ด้วย openpyxl — ทุกชีทเขียนเองผ่าน ws.cell อยู่แล้ว
+            # ไม่ได้ใช้ to_excel เลย wrapper ของ pd.ExcelWriter จึงไม่จำเป็น
+            # (โหมด write_only ใช้ไม่ได้ เพราะ layout เขียน Search UI ย้อนกลับ
+            # ไปไว้เหนือข้อมูลดิบหลังจากรู้ตำแหน่งแล้ว)
+            book = openpyxl.Workbook()
+            register_data_styles(book)
+            # เช็คชื่อชีทซ้ำจาก set ท้องถิ่น ไม่ไล่ book.sheetnames ใหม่ทุกไฟล์
+            used_sheet_names = set(book.sheetnames)
+
+            for item in files_to_process:
+                file_path = item["file"]
+                filename = os.path.basename(file_path)
+                chosen_d_date = item["d_date"]
+
+                # Sheet Name
+                desired_sheet_name = chosen_d_date if chosen_d_date else os.path.splitext(filename)[0]
+                
+                # Lookup Logic
+                clean_name = re.sub(r'GL', '', filename, flags=re.IGNORECASE)
+                clean_name = os.path.splitext(clean_name)[0].strip()
+                fallback_lookup_name = strip_d_suffix_for_tlf_sheet(clean_name)
+
+                tlf_lookup_candidates = []
+                if chosen_d_date:
+                    tlf_lookup_candidates.append(chosen_d_date)
+                    tlf_lookup_candidates.append("D" + chosen_d_date)
+                tlf_lookup_candidates.append(fallback_lookup_name)
+
+                tlf_sheet_to_use = next(
+                    (c for c in tlf_lookup_candidates if c and c in tlf_sheet_names_set), None
+                )
 
-                    # Sheet Name
-                    desired_sheet_name = chosen_d_date if chosen_d_date else os.path.splitext(filename)[0]
-                    
-                    # Lookup Logic
-                    clean_name = re.sub(r'GL', '', filename, flags=re.IGNORECASE)
-                    clean_name = os.path.splitext(clean_name)[0].strip()
-                    fallback_lookup_name = strip_d_suffix_for_tlf_sheet(clean_name)
-
-                    tlf_lookup_candidates = []
-                    if chosen_d_date:
-                        tlf_lookup_candidates.append(chosen_d_date)
-                        tlf_lookup_candidates.append("D" + chosen_d_date)
-                    tlf_lookup_candidates.append(fallback_lookup_name)
-
-                    tlf_sheet_to_use = None
-                    for cand in tlf_lookup_candidates:
-                        if cand and cand in tlf_book.sheet_names:
-                            tlf_sheet_to_use = cand
-                            break
-
-                    try:
-                        # --- Load TLF Data ---
-                        tlf_df = pd.DataFrame()
-                        if tlf_sheet_to_use:
-                            tlf_df = pd.read_excel(tlf_book, sheet_name=tlf_sheet_to_use, usecols=tlf_indices, dtype=str)
-                            for col in tlf_df.columns:
-                                tlf_df[col] = tlf_df[col].astype(str).str.strip()
+                try:
+                    # --- Load TLF Data ---
+                    tlf_df = pd.DataFrame()
+                    if tlf_sheet_to_use:
+                        tlf_df = tlf_sheet_cache.get(tlf_sheet_to_use)
+                        if tlf_df is None:
+                            # strip ตั้งแต่ตอนอ่านผ่าน converters แล้วประมวลผล
+                            # (implied decimal + SearchKey) ให้จบก่อนเก็บลง cache —
+                            # ทั้งหมดขึ้นกับเนื้อหาชีทอย่างเดียว ไฟล์ถัดไปที่ใช้ชีทเดียวกัน
+                            # จึง reuse ได้ตรงๆ โดยไม่ต้อง copy/คำนวณซ้ำ
+                            tlf_df = pd.read_excel(
+                                tlf_book,
+                                sheet_name=tlf_sheet_to_use,
+                                usecols=tlf_indices,
+                                converters={j: _cell_to_str for j in range(len(tlf_indices))},
+                            )
 
                             if pos_AZ != -1 and pos_AZ < len(tlf_df.columns):
-                                tlf_df.iloc[:, pos_AZ] = tlf_df.iloc[:, pos_AZ].apply(convert_implied_decimal)
+                                tlf_df.isetitem(pos_AZ, convert_implied_decimal(tlf_df.iloc[:, pos_AZ]))
                             if pos_CU != -1 and pos_CU < len(tlf_df.columns):
-                                tlf_df.iloc[:, pos_CU] = tlf_df.iloc[:, pos_CU].apply(convert_implied_decimal)
+                                tlf_df.isetitem(pos_CU, convert_implied_decimal(tlf_df.iloc[:, pos_CU]))
 
                             if not tlf_df.empty and len(tlf_df.columns) > 8:
                                 search_col = tlf_df.iloc[:, 8].astype(str).str.strip()
-                                tlf_df['_SearchKey'] = search_col + '|' + (tlf_df.groupby(search_col).cumcount() + 1).astype(str)
+                                tlf_df['_SearchKey'] = build_search_key(search_col)
 
-                        # --- Load Source Data (GL/TRF) ---
-                        # [FIX] ใช้ with block สำหรับ Source file ที่เป็น Excel ด้วย
-                        if filename.lower().endswith(('.xls', '.xlsx')):
-                             with pd.ExcelFile(file_path) as source_book:
-                                gl_df = pd.read_excel(source_book, header=None, usecols=gl_indices, dtype=str)
-                        else:
+                            tlf_sheet_cache[tlf_sheet_to_use] = tlf_df
+
+                    # --- Load Source Data (GL/TRF) ---
+                    # [FIX] ใช้ with block สำหรับ Source file ที่เป็น Excel ด้วย
+                    if filename.lower().endswith(('.xls', '.xlsx')):
+                         with pd.ExcelFile(file_path) as source_book:
+                            gl_df = pd.read_excel(source_book, header=None, usecols=gl_indices, dtype=str)
+                    else:
+                        # C engine ข้ามคอลัมน์ที่ไม่ได้อยู่ใน usecols ตั้งแต่ชั้น tokenizer
+                        # เร็วกว่า engine='python' หลายเท่า; ไฟล์ที่ C engine ไม่รับค่อยถอยไป parser เดิม
+                        try:
+                            gl_df = pd.read_csv(file_path, header=None, usecols=gl_indices, encoding='utf-8', dtype=str, engine='c')
+                        except Exception:
                             try:
-                                gl_df = pd.read_csv(file_path, header=None, usecols=gl_indices, encoding='utf-8', dtype=str, engine='python')
-                            except:
+                                gl_df = pd.read_csv(file_path, header=None, usecols=gl_indices, encoding='cp874', dtype=str, engine='c')
+                            except Exception:
                                 gl_df = pd.read_csv(file_path, header=None, usecols=gl_indices, encoding='cp874', dtype=str, engine='python')
 
-                        if len(gl_df.columns) == len(gl_new_headers):
-                            gl_df.columns = gl_new_headers
-
-                        gl_df['RC'] = gl_df['RC'].astype(str).str.strip()
-                        gl_df['CH'] = gl_df['CH'].astype(str).str.strip()
-                        gl_df['DR'] = pd.to_numeric(gl_df['DR'], errors='coerce').fillna(0)
-                        gl_df['CR'] = pd.to_numeric(gl_df['CR'], errors='coerce').fillna(0)
-
-                        if 'Seq' in gl_df.columns:
-                            gl_df['Seq'] = gl_df['Seq'].apply(extract_seq_num).astype(str).str.strip()
-
-                        cols_to_sort = ['CH', 'RC', 'OC', 'Product Code']
-                        valid_sort_cols = [c for c in cols_to_sort if c in gl_df.columns]
-                        if valid_sort_cols:
-                            gl_df = gl_df.sort_values(by=valid_sort_cols, ascending=[True]*len(valid_sort_cols))
-
-                        if not gl_df.empty:
-                            search_col_gl = gl_df['Seq'].astype(str)
-                            gl_df['_SearchKey'] = search_col_gl + '|' + (gl_df.groupby(search_col_gl).cumcount() + 1).astype(str)
-
-                        # --- Write to Excel (Layout Logic) ---
-                        target_sheet_name = make_unique_sheet_name(writer.book, desired_sheet_name)
-                        worksheet = writer.book.create_sheet(target_sheet_name)
-                        writer.sheets[target_sheet_name] = worksheet
-                        ws = writer.sheets[target_sheet_name]
-
-                        search_ui_start_row = 1
-                        tlf_ui_height = 2 + tlf_reserved_rows
-                        gl_ui_height = 2 + gl_reserved_rows
-                        raw_data_start_row = search_ui_start_row + tlf_ui_height + gap_rows + gl_ui_height + 5
-
-                        current_raw_row = raw_data_start_row
-                        tlf_data_start = tlf_data_end = None
-                        tlf_key_col_letter = 'A'
-                        gl_data_start = gl_data_end = None
-                        gl_key_col_letter = 'A'
-
-                        # Raw TLF
-                        if not tlf_df.empty:
-                            ws.cell(row=current_raw_row - 1, column=1, value="--- Raw TLF Data ---").font = Font(bold=True, italic=True)
-                            tlf_df.to_excel(writer, sheet_name=target_sheet_name, startrow=current_raw_row - 1, index=False)
-                            tlf_data_start = current_raw_row + 1
-                            tlf_data_end = current_raw_row + len(tlf_df)
-                            tlf_key_col_letter = get_column_letter(len(tlf_df.columns))
-                            
-                            for row in range(current_raw_row, tlf_data_end + 1):
-                                for col in range(1, len(tlf_df.columns)):
-                                    cell = ws.cell(row=row, column=col)
-                                    cell.border = thin_border
-                                    if row == current_raw_row:
-                                        cell.alignment = align_center
-                                        cell.font = header_font
-                                    else:
-                                        cell.alignment = align_right if isinstance(cell.value, (int, float)) else align_center
-                                        if col == 9: cell.number_format = '@'
-                            current_raw_row += len(tlf_df) + 4
-
-                        # Raw GL
-                        if not gl_df.empty:
-                            ws.cell(row=current_raw_row - 1, column=1, value="--- Raw ATMI Data ---").font = Font(bold=True, italic=True)
-                            gl_df.to_excel(writer, sheet_name=target_sheet_name, startrow=current_raw_row - 1, index=False)
-                            gl_data_start = current_raw_row + 1
-                            gl_data_end = current_raw_row + len(gl_df)
-                            gl_key_col_letter = get_column_letter(len(gl_df.columns))
-
-                            for row in range(current_raw_row, gl_data_end + 1):
-                                for col in range(1, len(gl_df.columns) + 1):
-                                    cell = ws.cell(row=row, column=col)
-                                    cell.border = thin_border
-                                    if row == current_raw_row:
-                                        cell.alignment = align_center
-                                        cell.font = header_font
-                                    else:
-                                        if col in [7, 8]:
-                                            cell.alignment = align_right
-                                            cell.number_format = '#,##0.00'
-                                        else:
-                                            cell.alignment = align_center
-                                        if col == 9: cell.number_format = '@'
-
-                        # --- Search UI ---
-                        ws[f'A{search_ui_start_row}'] = "🔍 ค้นหาข้อมูล SEQ"
-                        ws[f'A{search_ui_start_row}'].font = Font(bold=True, size=12)
-                        ws[f'A{search_ui_start_row}'].alignment = Alignment(horizontal='right')
-
-                        input_cell_ref = f'$B${search_ui_start_row}'
-                        input_cell = ws[f'B{search_ui_start_row}']
-                        input_cell.fill = search_fill
-                        input_cell.border = thin_border
-                        input_cell.alignment = align_center
-                        input_cell.number_format = '@'
-
-                        report_row = search_ui_start_row + 2
-
-                        # TLF Report Section
-                        if not tlf_df.empty:
-                            ws[f'A{report_row}'] = "TLF"
-                            ws[f'A{report_row}'].font = title_font
-                            
-                            display_cols = [c for c in tlf_df.columns if c != '_SearchKey' and c not in exclude_tlf_columns]
-                            if 'amt_1_full' in display_cols and 'resp_byte' in display_cols:
-                                idx1, idx2 = display_cols.index('amt_1_full'), display_cols.index('resp_byte')
-                                display_cols[idx1], display_cols[idx2] = display_cols[idx2], display_cols[idx1]
-
-                            current_col_idx = 1
-                            tlf_key_range_str = f"${tlf_key_col_letter}${tlf_data_start}:${tlf_key_col_letter}${tlf_data_end}"
-
-                            for col_name in display_cols:
-                                cell = ws.cell(row=report_row + 1, column=current_col_idx)
-                                cell.value = col_name
-                                cell.font = Font(bold=True)
+                    if len(gl_df.columns) == len(gl_new_headers):
+                        gl_df.columns = gl_new_headers
+
+                    gl_df['RC'] = gl_df['RC'].astype(str).str.strip()
+                    gl_df['CH'] = gl_df['CH'].astype(str).str.strip()
+                    gl_df['DR'] = pd.to_numeric(gl_df['DR'], errors='coerce').fillna(0)
+                    gl_df['CR'] = pd.to_numeric(gl_df['CR'], errors='coerce').fillna(0)
+
+                    if 'Seq' in gl_df.columns:
+                        # vectorized: regex วิ่งใน C ผ่าน .str.extract แทน apply ทีละแถว
+                        seq_str = gl_df['Seq'].astype(str)
+                        extracted = seq_str.str.extract(_SEQ_RE, expand=False)
+                        gl_df['Seq'] = extracted.fillna(seq_str.str.strip())
+
+                    cols_to_sort = ['CH', 'RC', 'OC', 'Product Code']
+                    valid_sort_cols = [c for c in cols_to_sort if c in gl_df.columns]
+                    if valid_sort_cols:
+                        # sort บน integer codes ของ categorical — เทียบ int เร็วกว่าเทียบ
+                        # string เป็นเท่าตัว (categories เรียง lexical เหมือน sort string เดิม)
+                        for c in valid_sort_cols:
+                            gl_df[c] = gl_df[c].astype('category')
+                        gl_df = gl_df.sort_values(by=valid_sort_cols, ascending=[True]*len(valid_sort_cols))
+
+                    if not gl_df.empty:
+                        gl_df['_SearchKey'] = build_search_key(gl_df['Seq'].astype(str))
+
+                    # --- Write to Excel (Layout Logic) ---
+                    target_sheet_name = make_unique_sheet_name(used_sheet_names, desired_sheet_name)
+                    used_sheet_names.add(target_sheet_name)
+                    ws = book.create_sheet(target_sheet_name)
+
+                    search_ui_start_row = 1
+                    tlf_ui_height = 2 + tlf_reserved_rows
+                    gl_ui_height = 2 + gl_reserved_rows
+                    raw_data_start_row = search_ui_start_row + tlf_ui_height + gap_rows + gl_ui_height + 5
+
+                    current_raw_row = raw_data_start_row
+                    tlf_data_start = tlf_data_end = None
+                    tlf_key_col_letter = 'A'
+                    gl_data_start = gl_data_end = None
+                    gl_key_col_letter = 'A'
+
+                    # Raw TLF
+                    if not tlf_df.empty:
+                        ws.cell(row=current_raw_row - 1, column=1, value="--- Raw TLF Data ---").font = raw_label_font
+                        tlf_data_start = current_raw_row + 1
+                        tlf_data_end = current_raw_row + len(tlf_df)
+                        tlf_key_col_letter = _COL_LETTERS[len(tlf_df.columns) - 1]
+
+                        # เขียนค่า + ใส่สไตล์จบใน pass เดียว
+                        # (เดิม to_excel ก่อนแล้ววนกลับมา restyle ทุก cell อีกรอบ)
+                        n_tlf_cols = len(tlf_df.columns)
+                        for c, col_name in enumerate(tlf_df.columns, 1):
+                            cell = ws.cell(row=current_raw_row, column=c, value=col_name)
+                            if c < n_tlf_cols:  # คอลัมน์ _SearchKey ท้ายสุดไม่ใส่สไตล์ (เหมือนเดิม)
+                                cell.style = 'raw_header'
+                        for r, row_vals in enumerate(tlf_df.itertuples(index=False, name=None), tlf_data_start):
+                            for c, value in enumerate(row_vals, 1):
+                                if isinstance(value, float) and value != value:
+                                    value = None  # NaN → cell ว่าง แบบเดียวกับ to_excel
+                                cell = ws.cell(row=r, column=c, value=value)
+                                if c >= n_tlf_cols:
+                                    continue
+                                if c == 9:
+                                    cell.style = 'data_text'
+                                elif isinstance(value, (int, float)):
+                                    cell.style = 'data_right'
+                                else:
+                                    cell.style = 'data_center'
+                        current_raw_row += len(tlf_df) + 4
+
+                    # Raw GL
+                    if not gl_df.empty:
+                        ws.cell(row=current_raw_row - 1, column=1, value="--- Raw ATMI Data ---").font = raw_label_font
+                        gl_data_start = current_raw_row + 1
+                        gl_data_end = current_raw_row + len(gl_df)
+                        gl_key_col_letter = _COL_LETTERS[len(gl_df.columns) - 1]
+
+                        for c, col_name in enumerate(gl_df.columns, 1):
+                            ws.cell(row=current_raw_row, column=c, value=col_name).style = 'raw_header'
+                        for r, row_vals in enumerate(gl_df.itertuples(index=False, name=None), gl_data_start):
+                            for c, value in enumerate(row_vals, 1):
+                                if isinstance(value, float) and value != value:
+                                    value = None  # NaN → cell ว่าง แบบเดียวกับ to_excel
+                                cell = ws.cell(row=r, column=c, value=value)
+                                if c in (7, 8):
+                                    cell.style = 'data_money'
+                                elif c == 9:
+                                    cell.style = 'data_text'
+                                else:
+                                    cell.style = 'data_center'
+
+                    # --- Search UI ---
+                    ws[f'A{search_ui_start_row}'] = "🔍 ค้นหาข้อมูล SEQ"
+                    ws[f'A{search_ui_start_row}'].font = search_title_font
+                    ws[f'A{search_ui_start_row}'].alignment = Alignment(horizontal='right')
+
+                    input_cell_ref = f'$B${search_ui_start_row}'
+                    input_cell = ws[f'B{search_ui_start_row}']
+                    input_cell.fill = search_fill
+                    input_cell.border = thin_border
+                    input_cell.alignment = align_center
+                    input_cell.number_format = '@'
+
+                    report_row = search_ui_start_row + 2
+
+                    # TLF Report Section
+                    if not tlf_df.empty:
+                        ws[f'A{report_row}'] = "TLF"
+                        ws[f'A{report_row}'].font = title_font
+                        
+                        display_cols = [c for c in tlf_df.columns if c != '_SearchKey' and c not in exclude_tlf_columns]
+                        if 'amt_1_full' in display_cols and 'resp_byte' in display_cols:
+                            idx1, idx2 = display_cols.index('amt_1_full'), display_cols.index('resp_byte')
+                            display_cols[idx1], display_cols[idx2] = display_cols[idx2], display_cols[idx1]
+
+                        current_col_idx = 1
+                        tlf_key_range_str = f"${tlf_key_col_letter}${tlf_data_start}:${tlf_key_col_letter}${tlf_data_end}"
+
+                        for col_name in display_cols:
+                            cell = ws.cell(row=report_row + 1, column=current_col_idx)
+                            cell.value = col_name
+                            cell.style = 'report_header'
+                            current_col_idx += 1
+
+                        data_start_row = report_row + 2
+                        # ช่วงข้อมูลของแต่ละคอลัมน์ไม่ขึ้นกับแถวสูตร — ประกอบ string รอบเดียว
+                        tlf_col_ranges = []
+                        for col_name in display_cols:
+                            col_letter = _COL_LETTERS[tlf_df.columns.get_loc(col_name)]
+                            tlf_col_ranges.append(f"${col_letter}${tlf_data_start}:${col_letter}${tlf_data_end}")
+
+                        for r_offset in range(tlf_reserved_rows):
+                            current_formula_row = data_start_row + r_offset
+                            match_logic = f'MATCH({input_cell_ref}&"|"&{r_offset + 1}, {tlf_key_range_str}, 0)'
+
+                            for i, data_col_range in enumerate(tlf_col_ranges, 1):
+                                cell = ws.cell(
+                                    row=current_formula_row, column=i,
+                                    value=f'=IFERROR(INDEX({data_col_range}, {match_logic}), "")',
+                                )
                                 cell.border = thin_border
                                 cell.alignment = align_center
-                                cell.fill = PatternFill(start_color="D9D9D9", end_color="D9D9D9", fill_type="solid")
-                                current_col_idx += 1
-
-                            data_start_row = report_row + 2
-                            for r_offset in range(tlf_reserved_rows):
-                                current_formula_row = data_start_row + r_offset
-                                k_value = r_offset + 1
-                                match_logic = f'MATCH({input_cell_ref}&"|"&{k_value}, {tlf_key_range_str}, 0)'
-
-                                for i, col_name in enumerate(display_cols, 1):
-                                    original_col_idx = tlf_df.columns.get_loc(col_name)
-                                    col_letter = get_column_letter(original_col_idx + 1)
-                                    data_col_range = f"${col_letter}${tlf_data_start}:${col_letter}${tlf_data_end}"
-                                    formula = f'=IFERROR(INDEX({data_col_range}, {match_logic}), "")'
-                                    
-                                    cell = ws.cell(row=current_formula_row, column=i)
-                                    cell.value = formula
-                                    cell.border = thin_border
-                                    cell.alignment = align_center
 
-                            report_row = data_start_row + tlf_reserved_rows
+                        report_row = data_start_row + tlf_reserved_rows
 
-                        report_row += gap_rows
+                    report_row += gap_rows
 
-                        # GL Report Section
-                        if not gl_df.empty:
-                            ws[f'A{report_row}'] = "ATMI"
-                            ws[f'A{report_row}'].font = title_font
-                            
-                            current_col_idx = 1
-                            for col_name in gl_df.columns:
-                                if col_name == '_SearchKey': continue
-                                cell = ws.cell(row=report_row + 1, column=current_col_idx)
-                                cell.value = col_name
-                                cell.font = Font(bold=True)
-                                cell.border = thin_border
-                                cell.alignment = align_center
-                                cell.fill = PatternFill(start_color="D9D9D9", end_color="D9D9D9", fill_type="solid")
-                                current_col_idx += 1
-                            
-                            data_start_row = report_row + 2
-                            gl_key_range_str = f"${gl_key_col_letter}${gl_data_start}:${gl_key_col_letter}${gl_data_end}"
-
-                            for r_offset in range(gl_reserved_rows):
-                                current_formula_row = data_start_row + r_offset
-                                k_value = r_offset + 1
-                                match_logic = f'MATCH({input_cell_ref}&"|"&{k_value}, {gl_key_range_str}, 0)'
-                                
-                                for col_idx in range(1, len(gl_new_headers) + 1):
-                                    col_letter = get_column_letter(col_idx)
-                                    data_col_range = f"${col_letter}${gl_data_start}:${col_letter}${gl_data_end}"
-                                    formula = f'=IFERROR(INDEX({data_col_range}, {match_logic}), "")'
-                                    
-                                    cell = ws.cell(row=current_formula_row, column=col_idx)
-                                    cell.value = formula
-                                    cell.border = thin_border
-                                    if col_idx in [7, 8]:
-                                        cell.number_format = '#,##0.00'
-                                        cell.alignment = align_right
-                                    else:
-                                        cell.alignment = align_center
-
-                        # Auto Width
-                        col_widths = {}
-                        def update_max_width(df, start_col_idx=1):
-                            for i, col_name in enumerate(df.columns):
-                                current_idx = start_col_idx + i
-                                max_len = len(str(col_name))
-                                if not df.empty:
-                                    try:
-                                        data_len = df[col_name].astype(str).map(len).max()
-                                        if pd.notna(data_len): max_len = max(max_len, data_len)
-                                    except: pass
-                                existing = col_widths.get(current_idx, 0)
-                                col_widths[current_idx] = max(existing, max_len + 3)
-
-                        if not tlf_df.empty: update_max_width(tlf_df)
-                        if not gl_df.empty: update_max_width(gl_df)
-
-                        for col_idx, width in col_widths.items():
-                            col_letter = get_column_letter(col_idx)
-                            writer.sheets[target_sheet_name].column_dimensions[col_letter].width = max(12, min(width, 60))
+                    # GL Report Section
+                    if not gl_df.empty:
+                        ws[f'A{report_row}'] = "ATMI"
+                        ws[f'A{report_row}'].font = title_font
+                        
+                        current_col_idx = 1
+                        for col_name in gl_df.columns:
+                            if col_name == '_SearchKey': continue
+                            cell = ws.cell(row=report_row + 1, column=current_col_idx)
+                            cell.value = col_name
+                            cell.style = 'report_header'
+                            current_col_idx += 1
                         
-                        writer.sheets[target_sheet_name].column_dimensions['A'].width = max(col_widths.get(1, 20), 30)
+                        data_start_row = report_row + 2
+                        gl_key_range_str = f"${gl_key_col_letter}${gl_data_start}:${gl_key_col_letter}${gl_data_end}"
+                        gl_col_ranges = [
+                            f"${_COL_LETTERS[ci]}${gl_data_start}:${_COL_LETTERS[ci]}${gl_data_end}"
+                            for ci in range(len(gl_new_headers))
+                        ]
+
+                        for r_offset in range(gl_reserved_rows):
+                            current_formula_row = data_start_row + r_offset
+                            match_logic = f'MATCH({input_cell_ref}&"|"&{r_offset + 1}, {gl_key_range_str}, 0)'
+
+                            for col_idx, data_col_range in enumerate(gl_col_ranges, 1):
+                                cell = ws.cell(
+                                    row=current_formula_row, column=col_idx,
+                                    value=f'=IFERROR(INDEX({data_col_range}, {match_logic}), "")',
+                                )
+                                cell.border = thin_border
+                                if col_idx in [7, 8]:
+                                    cell.number_format = '#,##0.00'
+                                    cell.alignment = align_right
+                                else:
+                                    cell.alignment = align_center
 
-                    except Exception as e:
-                        print(f"Error processing file {filename}: {e}")
+                    # Auto Width
+                    col_widths = {}
+                    def update_max_width(df, start_col_idx=1):
+                        for i, col_name in enumerate(df.columns):
+                            current_idx = start_col_idx + i
+                            max_len = len(str(col_name))
+                            if not df.empty:
+                                try:
+                                    # .str.len() วิ่งใน C ต่างจาก .map(len) ที่เรียก len() ทีละ cell
+                                    data_len = df[col_name].astype(str).str.len().max()
+                                    if pd.notna(data_len): max_len = max(max_len, data_len)
+                                except: pass
+                            existing = col_widths.get(current_idx, 0)
+                            col_widths[current_idx] = max(existing, max_len + 3)
+
+                    if not tlf_df.empty: update_max_width(tlf_df)
+                    if not gl_df.empty: update_max_width(gl_df)
+
+                    for col_idx, width in col_widths.items():
+                        col_letter = _COL_LETTERS[col_idx - 1]
+                        ws.column_dimensions[col_letter].width = max(12, min(width, 60))
+                    
+                    ws.column_dimensions['A'].width = max(col_widths.get(1, 20), 30)
+
+                except Exception as e:
+                    print(f"Error processing file {filename}: {e}")
 
-                if 'Sheet' in writer.book.sheetnames and len(writer.book.sheetnames) > 1:
-                    del writer.book['Sheet']
+            if 'Sheet' in book.sheetnames and len(book.sheetnames) > 1:
+                del book['Sheet']
+            book.save(output)
 
     except Exception as e:
         return None, f"Error อ่านไฟล์ TLF: {e}"
@@ -418,19 +522,33 @@ if uploaded_zip:
             # Create temp directory
             with tempfile.TemporaryDirectory() as temp_dir:
                 try:
-                    # Extract ZIP
+                    # Extract ZIP — แตกเฉพาะไฟล์ข้อมูลที่ใช้จริง
+                    # ข้าม __MACOSX / hidden / นามสกุลอื่น ไม่ต้องเสียเวลา+พื้นที่แตกทั้ง archive
+                    # ไฟล์ TLF คัดจากชื่อ ไม่กรองนามสกุล (เช่น TLF*.xlsm ต้องผ่าน)
+                    data_exts = ('.xlsx', '.xls', '.csv', '.trf', '.txt')
                     with zipfile.ZipFile(uploaded_zip, 'r') as zip_ref:
-                        zip_ref.extractall(temp_dir)
+                        for info in zip_ref.infolist():
+                            if info.is_dir():
+                                continue
+                            parts = info.filename.split('/')
+                            if any(p == '__MACOSX' or p.startswith('.') for p in parts):
+                                continue
+                            if "TLF" not in parts[-1] and not info.filename.lower().endswith(data_exts):
+                                continue
+                            zip_ref.extract(info, temp_dir)
                     
                     # Identify Files
                     tlf_path = None
                     source_files = []
                     
                     for root, dirs, files in os.walk(temp_dir):
+                        # ตัด directory ขยะ (__MACOSX / hidden) ออกตั้งแต่ตรงนี้
+                        # os.walk จะไม่เดินลงไปเลย ไม่ต้องเช็คชื่อ root ซ้ำทุกไฟล์
+                        dirs[:] = [d for d in dirs if d != '__MACOSX' and not d.startswith('.')]
                         for file in files:
-                            if file.startswith('.') or '__MACOSX' in root:
+                            if file.startswith('.'):
                                 continue
-                            
+
                             full_path = os.path.join(root, file)
                             
                             if "TLF" in file: